@@ -1,24 +1,61 @@
 import asyncio
-import httpx
+import aiohttp
 import re
 import sys
 import os
-from concurrent.futures import ProcessPoolExecutor
 import argparse
+from contextlib import asynccontextmanager
+from typing import BinaryIO, TextIO
 from urllib.parse import urlparse, urlunparse
 
 
-# Define parameter URL regex pattern
-PARAM_PATTERN = re.compile(r".*\?.*=.*")
+# Runs of two or more slashes in a URL path
+_SLASH_RE = re.compile(r"/{2,}")
 
 WAYBACK_API = "https://web.archive.org/cdx/search/cdx"
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (compatible; WaybackFetcher/1.0)"
 }
 
+# Wayback rate-limits aggressive clients, so cap in-flight CDX requests across all domains
+CDX_CONCURRENCY = asyncio.Semaphore(4)
+DOMAIN_CONCURRENCY = asyncio.Semaphore(8)
+MAX_ATTEMPTS = 5
 
-async def fetch_all_urls(domain: str, output_queue: asyncio.Queue) -> list[str]:
-    """Fetch all URLs from Wayback Machine for a specific domain with streaming."""
+# Output files see a steady stream of short lines, so buffer generously to cut write syscalls
+WRITE_BUFFER_SIZE = 1 << 20
+READ_CHUNK_SIZE = 64 * 1024
+
+# Running totals across all domains; only touched from the event loop, so no locking needed
+_progress = {"urls": 0, "params": 0, "domains": 0}
+PROGRESS_INTERVAL = 10000
+
+
+@asynccontextmanager
+async def cdx_request(session: aiohttp.ClientSession, params: dict, timeout: aiohttp.ClientTimeout):
+    """Open a CDX request, backing off while Wayback answers with HTTP 429 or 503."""
+    async with CDX_CONCURRENCY:
+        for attempt in range(MAX_ATTEMPTS):
+            response = await session.get(WAYBACK_API, params=params, headers=HEADERS, timeout=timeout)
+            if response.status not in (429, 503) or attempt == MAX_ATTEMPTS - 1:
+                break
+            retry_after = response.headers.get("Retry-After")
+            response.release()
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                delay = 2 ** attempt
+            print(f"\n⏳ Wayback returned {response.status}, retrying in {delay:g}s...")
+            await asyncio.sleep(delay)
+
+        async with response:
+            response.raise_for_status()
+            yield response
+
+
+async def fetch_all_urls(domain: str, session: aiohttp.ClientSession, all_fp: BinaryIO,
+                         param_fp: TextIO) -> tuple[int, int]:
+    """Stream all URLs for a domain from Wayback Machine, filtering and saving them as they arrive."""
     params = {
         "url": f"*.{domain}/*",
         "collapse": "urlkey",
@@ -26,26 +63,109 @@ async def fetch_all_urls(domain: str, output_queue: asyncio.Queue) -> list[str]:
         "fl": "original"
     }
 
-    lines = []
-    async with httpx.AsyncClient(headers=HEADERS, timeout=120) as client:
-        async with client.stream("GET", WAYBACK_API, params=params) as response:
-            response.raise_for_status()
-            count = 0
-            async for line in response.aiter_lines():
-                if line:
-                    lines.append(line)
-                    count += 1
-                    if count % 1000 == 0:
-                        print(f"\r• Streamed {count} URLs for {domain}...", end="", flush=True)
-                        # Send partial results to output queue
-                        await output_queue.put(("partial", domain, count, 0))
+    # Limit each connect/read step rather than the whole stream, which can legitimately run for minutes
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=120, sock_read=120)
+
+    # Ask CDX how many pages the result spans so they can be fetched in parallel
+    page_params = {**params, "showNumPages": "true"}
+    async with cdx_request(session, page_params, timeout) as response:
+        num_pages_text = (await response.text()).strip()
+    try:
+        pages = list(range(int(num_pages_text or 1)))
+        print(f"• {len(pages)} CDX pages to fetch for {domain}")
+    except ValueError:
+        # Not a page count (e.g. an HTML error page); fall back to a single unpaged request
+        pages = [None]
+        print(f"⚠️ Unexpected page count reply for {domain}, fetching without pagination")
 
-    print(f"\n✅ Total URLs fetched for {domain}: {len(lines)}")
-    return lines
+    counts = {"urls": 0, "params": 0}
+    # Hashes of parameter URLs already written; collapse=urlkey still lets normalized duplicates through
+    seen: set[int] = set()
+    # Bind the per-line methods once instead of looking them up for every URL
+    write_all = all_fp.write
+    write_param = param_fp.write
+    mark_seen = seen.add
+
+    def handle_line(line: bytes):
+        line = line.strip()
+        if not line:
+            return
+        write_all(line + b"\n")
+        counts["urls"] += 1
+        _progress["urls"] += 1
+
+        param_url = is_param_url(line)
+        if param_url and (url_hash := hash(param_url)) not in seen:
+            mark_seen(url_hash)
+            write_param(param_url + "\n")
+            counts["params"] += 1
+            _progress["params"] += 1
+
+        if _progress["urls"] % PROGRESS_INTERVAL == 0:
+            print(f"\r• Progress: {_progress['urls']} URLs fetched, "
+                  f"{_progress['params']} parameter URLs", end="", flush=True)
+
+    async def fetch_page(page: int | None):
+        page_params = params if page is None else {**params, "page": str(page)}
+        async with cdx_request(session, page_params, timeout) as response:
+            # Split raw chunks on newlines ourselves; lines stay bytes until they are known to matter
+            pending = b""
+            async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    handle_line(line)
+            if pending:
+                handle_line(pending)
+
+    tasks = [asyncio.create_task(fetch_page(page)) for page in pages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the remaining pages so they don't keep writing for a domain that already failed
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    print(f"\n✅ Total URLs fetched for {domain}: {counts['urls']}")
+    return counts["urls"], counts["params"]
 
 
 def normalize_url(url: str) -> str:
     """Normalize URL to ensure consistent format."""
+    # Split plain scheme://netloc/path?query URLs by hand; anything else goes through urlparse
+    scheme_end = url.find("://")
+    if scheme_end <= 0 or not url[:scheme_end].isalnum():
+        return _normalize_url_parsed(url)
+
+    scheme = url[:scheme_end]
+    netloc_start = scheme_end + 3
+    netloc_end = len(url)
+    for sep in "/?#":
+        i = url.find(sep, netloc_start, netloc_end)
+        if i != -1:
+            netloc_end = i
+    path_end = len(url)
+    for sep in "?#":
+        i = url.find(sep, netloc_end, path_end)
+        if i != -1:
+            path_end = i
+
+    # Normalize scheme and netloc to lowercase
+    netloc = url[netloc_start:netloc_end].lower()
+    scheme = scheme.lower()
+
+    # Normalize path (remove double slashes)
+    path = url[netloc_end:path_end]
+    if "//" in path:
+        path = _SLASH_RE.sub("/", path)
+
+    return f"{scheme}://{netloc}{path}{url[path_end:]}"
+
+
+def _normalize_url_parsed(url: str) -> str:
+    """Normalize URL via urlparse, for URLs the fast path does not handle."""
     try:
         # Parse URL
         parsed = urlparse(url)
@@ -54,7 +174,9 @@ def normalize_url(url: str) -> str:
         netloc = parsed.netloc.lower()
         
         # Normalize path (remove double slashes)
-        path = re.sub(r'/+', '/', parsed.path)
+        path = parsed.path
+        if "//" in path:
+            path = _SLASH_RE.sub("/", path)
         
         # Normalize query parameters
         query = parsed.query
@@ -70,88 +192,43 @@ def normalize_url(url: str) -> str:
         ))
         
         return normalized
-    except:
+    except ValueError:
         # If parsing fails, return original URL
         return url
 
 
-def is_param_url(url: str) -> str | None:
-    """Check if URL contains parameters."""
-    normalized = normalize_url(url)
-    return normalized if PARAM_PATTERN.search(normalized) else None
-
-
-def filter_urls_parallel(urls: list[str]) -> list[str]:
-    """Filter URLs using multiple CPU cores."""
-    print("🔍 Filtering in parallel (multi-core)...")
-    with ProcessPoolExecutor() as executor:
-        results = list(executor.map(is_param_url, urls))
-    filtered = [url for url in results if url]
-    print(f"✅ Filtered: {len(filtered)} parameter URLs")
-    return filtered
-
-
-async def append_to_file(filename: str, data: list[str]):
-    """Append data to file instead of overwriting."""
-    def write_file():
-        with open(filename, "a", encoding="utf-8") as f:
-            f.write('\n'.join(data) + '\n')
-    await asyncio.to_thread(write_file)
+def is_param_url(url: bytes) -> str | None:
+    """Check if a raw URL contains parameters, returning it normalized if so."""
+    # Cheap substring checks first; most Wayback URLs have no query string and are never decoded
+    q = url.find(b"?")
+    if q == -1 or url.find(b"=", q) == -1:
+        return None
+    return normalize_url(url.decode("utf-8", errors="replace"))
 
 
-async def process_domain(domain: str, output_queue: asyncio.Queue) -> tuple[int, int]:
-    """Process one domain and save results immediately."""
-    print(f"\n🌐 Processing domain: {domain}")
-    
-    print(f"🌐 Fetching URLs from Wayback Machine for {domain}...")
-    all_urls = await fetch_all_urls(domain, output_queue)
-
-    print(f"🧹 Filtering URLs by parameters for {domain}...")
-    filtered_urls = filter_urls_parallel(all_urls)
-    
-    # Save results for this domain immediately
-    await asyncio.gather(
-        append_to_file("all_urls.txt", all_urls),
-        append_to_file("param_urls.txt", filtered_urls)
-    )
-    
-    print(f"✅ Processed {domain}: {len(all_urls)} URLs, {len(filtered_urls)} parameter URLs")
-    
-    # Send completion signal to output queue
-    await output_queue.put(("complete", domain, len(all_urls), len(filtered_urls)))
+async def process_domain(domain: str, session: aiohttp.ClientSession, all_fp: BinaryIO,
+                         param_fp: TextIO) -> tuple[int, int]:
+    """Process one domain, saving results while they stream in."""
+    async with DOMAIN_CONCURRENCY:
+        print(f"\n🌐 Processing domain: {domain}")
+        
+        print(f"🌐 Fetching and filtering URLs from Wayback Machine for {domain}...")
+        try:
+            all_count, param_count = await fetch_all_urls(domain, session, all_fp, param_fp)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Report the failed domain without aborting the others
+            print(f"\n❌ Failed to fetch {domain}: {e!r} (URLs streamed before the failure were kept)")
+            return 0, 0
+        _progress["domains"] += 1
     
-    return len(all_urls), len(filtered_urls)
-
-
-async def output_manager(output_queue: asyncio.Queue):
-    """Manage real-time output and progress reporting."""
-    total_all_urls = 0
-    total_param_urls = 0
-    processed_domains = 0
+    print(f"\n✅ Domain {domain} completed:")
+    print(f"   • {all_count} URLs found")
+    print(f"   • {param_count} parameter URLs found")
+    print(f"📊 Overall progress: {_progress['domains']} domains processed")
+    print(f"   • Total URLs: {_progress['urls']}")
+    print(f"   • Total parameter URLs: {_progress['params']}")
     
-    while True:
-        msg_type, domain, all_count, param_count = await output_queue.get()
-        
-        if msg_type == "partial":
-            # Update progress during URL fetching
-            print(f"\r• Progress: {total_all_urls + all_count} URLs fetched, {total_param_urls} parameter URLs", end="")
-        elif msg_type == "complete":
-            # Update final counts for completed domain
-            total_all_urls += all_count
-            total_param_urls += param_count
-            processed_domains += 1
-            
-            print(f"\n✅ Domain {domain} completed:")
-            print(f"   • {all_count} URLs found")
-            print(f"   • {param_count} parameter URLs found")
-            print(f"📊 Overall progress: {processed_domains} domains processed")
-            print(f"   • Total URLs: {total_all_urls}")
-            print(f"   • Total parameter URLs: {total_param_urls}")
-            
-            # Check if we're done (this would be set by main)
-            if output_queue.qsize() == 0 and processed_domains == len(domains):
-                break
-        output_queue.task_done()
+    return all_count, param_count
 
 
 async def main():
@@ -183,31 +260,24 @@ async def main():
     print(f"   • all_urls.txt (all URLs)")
     print(f"   • param_urls.txt (parameter URLs)")
     
-    # Create output queue for real-time updates
-    output_queue = asyncio.Queue()
-    
-    # Start output manager
-    output_task = asyncio.create_task(output_manager(output_queue))
-    
-    # Process each domain concurrently
-    tasks = []
-    for domain in domains:
-        task = asyncio.create_task(process_domain(domain, output_queue))
-        tasks.append(task)
-    
-    # Wait for all domains to be processed
-    await asyncio.gather(*tasks)
-    
-    # Signal completion to output manager
-    await output_queue.put(("done", "", 0, 0))
-    
-    # Wait for output manager to finish
-    await output_task
+    # Share one connection pool and one handle per output file across all domains
+    connector = aiohttp.TCPConnector(limit=32, limit_per_host=4, ttl_dns_cache=300)
+    with open("all_urls.txt", "ab", buffering=WRITE_BUFFER_SIZE) as all_fp, \
+            open("param_urls.txt", "a", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as param_fp:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # Process each domain concurrently
+            tasks = []
+            for domain in domains:
+                task = asyncio.create_task(process_domain(domain, session, all_fp, param_fp))
+                tasks.append(task)
+
+            # Wait for all domains to be processed
+            await asyncio.gather(*tasks)
     
     print(f"\n✅ All domains processed!")
     print(f"📊 Final results:")
-    print(f"   • all_urls.txt: {total_all_urls} URLs")
-    print(f"   • param_urls.txt: {total_param_urls} parameter URLs")
+    print(f"   • all_urls.txt: {_progress['urls']} URLs")
+    print(f"   • param_urls.txt: {_progress['params']} parameter URLs")
 
 
 if __name__ == "__main__":